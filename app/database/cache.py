@@ -1,30 +1,51 @@
 """SQLite cache database connection and session management."""
 from pathlib import Path
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import Session
 
-from app.settings import settings
+from app.database.session import session_factory
+from app.database.sqlite import enable_sqlite_pragmas, immediate_transaction, sqlite_pool_options
+from app.settings import get_settings
 
-# Ensure data directory exists
-cache_path = Path(settings.cache_database_path)
-cache_path.parent.mkdir(parents=True, exist_ok=True)
 
-# SQLite connection string
-CACHE_DATABASE_URL = f"sqlite:///{settings.cache_database_path}"
+def _create_cache_engine():
+    """Create the SQLite engine for the cache database."""
+    db_path = get_settings().cache_database_path
+    # Ensure data directory exists
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    
+    engine = create_engine(
+        f"sqlite:///{db_path}",
+        connect_args={"check_same_thread": False},  # Required for SQLite with FastAPI
+        **sqlite_pool_options(db_path)
+    )
+    enable_sqlite_pragmas(engine)
+    return engine
 
-engine = create_engine(
-    CACHE_DATABASE_URL,
-    connect_args={"check_same_thread": False}  # Required for SQLite with FastAPI
-)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = _create_cache_engine()
+
+SessionLocal = session_factory(engine)
 
 
 def init_cache_db():
-    """Initialize cache database tables."""
-    from app.models.cache import CacheBase
-    CacheBase.metadata.create_all(bind=engine)
+    """Initialize cache database tables.
+
+    The cache is disposable, so a table left over from an older schema is
+    dropped and recreated rather than migrated.
+    """
+    from app.models.cache import CacheBase, CachedStarmap
+    table = CachedStarmap.__table__
+    # Under the write lock, so workers starting together never drop a table
+    # another one has just created
+    with immediate_transaction(engine) as conn:
+        inspector = inspect(conn)
+        if inspector.has_table(table.name):
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            if existing != set(table.columns.keys()):
+                table.drop(bind=conn)
+        CacheBase.metadata.create_all(bind=conn)
 
 
 def get_cache_db() -> Session:
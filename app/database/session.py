@@ -0,0 +1,17 @@
+"""Session factory shared by the cache and storage databases."""
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+
+def session_factory(engine: Engine) -> sessionmaker:
+    """
+    sessionmaker for an engine with autoflush and expire-on-commit off.
+    
+    Writes go through Core statements, so there is nothing pending to
+    autoflush, and rows read before a commit stay usable after it without a
+    reload SELECT. That assumes short-lived sessions: Session.get() answers
+    from the identity map without querying, so a long-lived session would
+    keep returning rows as first loaded. The cleanup task's pinned session
+    only issues Core DELETEs and never loads ORM objects.
+    """
+    return sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
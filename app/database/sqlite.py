@@ -0,0 +1,93 @@
+"""SQLite connection tuning shared by the cache and storage engines."""
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from app.settings import get_settings
+
+
+def sqlite_pragmas() -> tuple:
+    """PRAGMAs applied to every new DBAPI connection.
+
+    With the defaults, WAL lets readers proceed while the cleanup task or a
+    cache insert is writing, and synchronous=NORMAL only fsyncs at
+    checkpoints instead of on every commit.
+    """
+    settings = get_settings()
+    return (
+        f"PRAGMA journal_mode={settings.sqlite_journal_mode}",
+        f"PRAGMA synchronous={settings.sqlite_synchronous}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA cache_size=-{settings.sqlite_cache_size_kb:d}",  # Negative = KiB
+        f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms:d}",
+        f"PRAGMA mmap_size={settings.sqlite_mmap_size:d}",
+    )
+
+
+def enable_sqlite_pragmas(engine: Engine) -> None:
+    """Register a connect hook that applies sqlite_pragmas() once per connection."""
+    pragmas = sqlite_pragmas()
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        if connection_record.info.get("sqlite_pragmas_applied"):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+        connection_record.info["sqlite_pragmas_applied"] = True
+
+
+def sqlite_pool_options(db_path: str) -> dict:
+    """Pool arguments for create_engine() on a SQLite database.
+
+    In-memory databases exist per connection, so they share one StaticPool
+    connection. File databases get a QueuePool; under WAL several readers
+    can use their connections in parallel.
+    """
+    if db_path in ("", ":memory:"):
+        return {"poolclass": StaticPool}
+    settings = get_settings()
+    return {
+        "poolclass": QueuePool,
+        "pool_size": settings.sqlite_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": True,
+    }
+
+
+@contextmanager
+def immediate_transaction(engine: Engine, busy_timeout_ms: Optional[int] = None) -> Iterator[Connection]:
+    """
+    Connection inside BEGIN IMMEDIATE, committed when the block exits cleanly.
+    
+    The write lock is taken before anything is read, so concurrent callers
+    (e.g. several workers starting at once) run one after another and each
+    sees what the previous one committed. Waiting callers give up after
+    busy_timeout_ms, or the configured sqlite_busy_timeout_ms.
+    """
+    with engine.connect() as conn:
+        # pysqlite only opens transactions implicitly before DML and as
+        # DEFERRED; autocommit mode leaves BEGIN/COMMIT to us
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if busy_timeout_ms is not None:
+            conn.exec_driver_sql(f"PRAGMA busy_timeout={busy_timeout_ms:d}")
+        try:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+            conn.exec_driver_sql("COMMIT")
+        finally:
+            if busy_timeout_ms is not None:
+                conn.exec_driver_sql(f"PRAGMA busy_timeout={get_settings().sqlite_busy_timeout_ms:d}")
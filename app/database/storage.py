@@ -1,38 +1,159 @@
 """Storage database connection and session management (PostgreSQL or SQLite)."""
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
 
-from app.settings import settings
+from app.database.session import session_factory
+from app.database.sqlite import enable_sqlite_pragmas, immediate_transaction, sqlite_pool_options
+from app.settings import get_settings
+
+__all__ = ["engine", "SessionLocal", "init_storage_db", "upgrade_storage_schema", "get_storage_db", "get_storage_type"]
 
 
 def _create_storage_engine():
     """Create the appropriate engine based on storage type."""
+    settings = get_settings()
     if settings.is_sqlite_storage:
         # SQLite configuration
         # Extract path from connection string if it's a SQLite URL
         db_path = settings.database_url.replace("sqlite:///", "")
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
         
-        return create_engine(
+        engine = create_engine(
             settings.database_url,
-            connect_args={"check_same_thread": False}  # Required for SQLite with FastAPI
+            connect_args={"check_same_thread": False},  # Required for SQLite with FastAPI
+            **sqlite_pool_options(db_path)
         )
+        enable_sqlite_pragmas(engine)
+        return engine
     else:
         # PostgreSQL configuration
-        return create_engine(settings.database_url, pool_pre_ping=True)
+        return create_engine(
+            settings.database_url,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=True
+        )
 
 
 engine = _create_storage_engine()
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = session_factory(engine)
+
+
+# Rows read per SELECT by _migrate_image_data()
+IMAGE_MIGRATION_BATCH_SIZE = 100
+
+# Workers starting together wait this long for another one's upgrade
+MIGRATION_LOCK_TIMEOUT_MS = 3_600_000
+
+# pg_advisory_xact_lock key held while the schema is created and upgraded
+MIGRATION_LOCK_KEY = 0x73746172636861
 
 
 def init_storage_db():
-    """Initialize storage database tables."""
-    from app.models.starmap import StorageBase
-    StorageBase.metadata.create_all(bind=engine)
+    """Initialize storage database tables and bring older ones up to date."""
+    upgrade_storage_schema(engine)
+
+
+def upgrade_storage_schema(db_engine: Engine) -> None:
+    """
+    Create the storage tables and upgrade ones left by older releases.
+    
+    Everything runs in one transaction under a database-wide lock, so when
+    several workers start at once the first does the work and the others
+    find nothing left to do. A failure rolls the whole upgrade back.
+    """
+    from app.models.starmap import StorageBase, Starmap
+    with _migration_transaction(db_engine) as conn:
+        StorageBase.metadata.create_all(bind=conn)
+        _migrate_image_data(conn)
+        _drop_brin_observed_index(conn)
+        # create_all() skips existing tables, so add indexes they predate
+        for index in Starmap.__table__.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+@contextmanager
+def _migration_transaction(db_engine: Engine) -> Iterator[Connection]:
+    """Transaction holding the lock that serializes schema upgrades."""
+    if db_engine.dialect.name == "sqlite":
+        with immediate_transaction(db_engine, busy_timeout_ms=MIGRATION_LOCK_TIMEOUT_MS) as conn:
+            yield conn
+    else:
+        with db_engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            yield conn
+
+
+def _drop_brin_observed_index(conn: Connection) -> None:
+    """
+    Drop idx_starmaps_observed if an earlier release built it as BRIN.
+    
+    observed_at is the sky date a user picks, not the insert time, so every
+    block range spans nearly all values and BRIN cannot prune. The index is
+    recreated as a B-tree afterwards.
+    """
+    if conn.dialect.name != "postgresql":
+        return
+    indexdef = conn.execute(
+        text("SELECT indexdef FROM pg_indexes WHERE tablename = 'starmaps' AND indexname = 'idx_starmaps_observed'")
+    ).scalar_one_or_none()
+    if indexdef is not None and "USING brin" in indexdef:
+        conn.execute(text("DROP INDEX idx_starmaps_observed"))
+
+
+def _migrate_image_data(conn: Connection) -> None:
+    """
+    Move PNGs from the old starmaps.image_data column onto the filesystem.
+    
+    Each BLOB is written to storage_image_dir through image_store, named by
+    the row id, and its image_path and image_sha1 are set before the column
+    is dropped. If the transaction rolls back, the next start rewrites the
+    same files.
+    """
+    from app.services import image_store
+    
+    columns = {column["name"] for column in inspect(conn).get_columns("starmaps")}
+    if "image_data" not in columns:
+        return
+    
+    if "image_path" not in columns:
+        conn.execute(text("ALTER TABLE starmaps ADD COLUMN image_path VARCHAR(255)"))
+    if "image_sha1" not in columns:
+        conn.execute(text("ALTER TABLE starmaps ADD COLUMN image_sha1 VARCHAR(40)"))
+    
+    image_dir = get_settings().storage_image_dir
+    while True:
+        rows = conn.execute(
+            text("SELECT id, image_data FROM starmaps WHERE image_path IS NULL LIMIT :n"),
+            {"n": IMAGE_MIGRATION_BATCH_SIZE},
+        ).all()
+        for row_id, image_data in rows:
+            path, sha1 = image_store.write_image(image_dir, uuid.UUID(str(row_id)).hex, image_data)
+            conn.execute(
+                text("UPDATE starmaps SET image_path = :path, image_sha1 = :sha1 WHERE id = :id"),
+                {"path": path, "sha1": sha1, "id": row_id},
+            )
+        if len(rows) < IMAGE_MIGRATION_BATCH_SIZE:
+            break
+    
+    conn.execute(text("ALTER TABLE starmaps DROP COLUMN image_data"))
+    # SQLite can only add NOT NULL by rebuilding the table; every row has a
+    # path by now and the model still declares the columns NOT NULL
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(
+            "ALTER TABLE starmaps ALTER COLUMN image_path SET NOT NULL, "
+            "ALTER COLUMN image_sha1 SET NOT NULL"
+        ))
 
 
 def get_storage_db() -> Session:
@@ -46,5 +167,5 @@ def get_storage_db() -> Session:
 
 def get_storage_type() -> str:
     """Return current storage type for informational purposes."""
-    return settings.storage_type
+    return get_settings().storage_type
 
@@ -1,13 +1,19 @@
 """Dependency injection for FastAPI routes."""
-from fastapi import Depends, HTTPException, Security, status
+from concurrent.futures import Executor
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request, Security, status
 from fastapi.security import APIKeyHeader
 
-from app.settings import settings
+from app.settings import Settings, get_settings
 
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 
-async def verify_api_key(api_key: str = Security(api_key_header)) -> str:
+async def verify_api_key(
+    api_key: str = Security(api_key_header),
+    settings: Settings = Depends(get_settings)
+) -> str:
     """Validate API key from request header."""
     if not api_key:
         raise HTTPException(
@@ -23,3 +29,7 @@ async def verify_api_key(api_key: str = Security(api_key_header)) -> str:
     
     return api_key
 
+
+def get_render_pool(request: Request) -> Optional[Executor]:
+    """Process pool for star map rendering (None falls back to the default executor)."""
+    return getattr(request.app.state, "render_pool", None)
@@ -1,27 +1,35 @@
 import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.orm import Session
 
-from app.database.cache import init_cache_db, get_cache_db, SessionLocal as CacheSessionLocal
+from app.database.cache import init_cache_db, get_cache_db, engine as cache_engine, SessionLocal as CacheSessionLocal
 from app.database.storage import init_storage_db, get_storage_type
 from app.routers import starmaps
-from app.services.starmap import cleanup_old_cache
-from app.settings import settings
+from app.services.render_pool import create_render_pool
+from app.services.starmap import cache_has_entries, cleanup_old_cache, load_cache_row_count
+from app.settings import Settings, get_settings
 
 logger = logging.getLogger(__name__)
 
-# Flag to control the background task
-_cleanup_task_running = False
 
+def _run_cache_cleanup(db: Session, max_age_hours: int) -> int:
+    """One cleanup pass; runs on the cleanup thread, never the event loop."""
+    db.rollback()  # Start from a clean transaction state
+    try:
+        return cleanup_old_cache(db, max_age_hours=max_age_hours)
+    except Exception:
+        db.rollback()
+        raise
 
-async def cache_cleanup_task():
-    """Background task that periodically cleans up old cache entries."""
-    global _cleanup_task_running
-    _cleanup_task_running = True
-    
+
+async def cache_cleanup_task(shutdown_event: asyncio.Event):
+    """Background task that periodically cleans up old cache entries until shutdown."""
+    settings = get_settings()
     interval_seconds = settings.cache_cleanup_interval_minutes * 60
     max_age_hours = settings.cache_max_age_hours
     
@@ -30,60 +38,78 @@ async def cache_cleanup_task():
         f"removing entries older than {max_age_hours} hours"
     )
     
-    while _cleanup_task_running:
-        try:
-            # Wait first, then cleanup (gives time for system to stabilize on startup)
-            await asyncio.sleep(interval_seconds)
-            
-            if not _cleanup_task_running:
+    # One session pinned to one connection for the life of the task, so
+    # SQLite's page cache for the created_at index stays warm between runs.
+    # Passes run on a dedicated thread so the blocking deletes and file
+    # unlinks never stall request handling on the event loop.
+    connection = cache_engine.connect()
+    db = CacheSessionLocal(bind=connection)
+    cleanup_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-cleanup")
+    loop = asyncio.get_running_loop()
+    try:
+        while not shutdown_event.is_set():
+            try:
+                # Wait first, then cleanup (gives time for system to stabilize on startup).
+                # Shutdown wakes the wait immediately instead of cancelling mid-cleanup.
+                await asyncio.wait_for(shutdown_event.wait(), timeout=interval_seconds)
                 break
+            except asyncio.TimeoutError:
+                pass
+            
+            if not cache_has_entries():
+                logger.debug("Cache is empty, skipping cleanup")
+                continue
             
-            # Run cleanup in a sync context (SQLite session)
-            db = CacheSessionLocal()
             try:
-                cleanup_old_cache(db, max_age_hours=max_age_hours)
-                logger.info("Cache cleanup completed successfully")
+                removed = await loop.run_in_executor(
+                    cleanup_thread, _run_cache_cleanup, db, max_age_hours
+                )
+                logger.info(f"Cache cleanup completed successfully, removed {removed} entries")
             except Exception as e:
                 logger.error(f"Cache cleanup failed: {e}")
-            finally:
-                db.close()
-                
-        except asyncio.CancelledError:
-            logger.info("Cache cleanup task cancelled")
-            break
-        except Exception as e:
-            logger.error(f"Unexpected error in cache cleanup task: {e}")
-            # Continue running despite errors
-            await asyncio.sleep(60)  # Brief pause before retrying
+    finally:
+        cleanup_thread.shutdown(wait=True)
+        db.close()
+        connection.close()
+    
+    logger.info("Cache cleanup task stopped")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup/shutdown events."""
-    global _cleanup_task_running
-    
     # Startup
     init_cache_db()
     init_storage_db()
     
+    db = CacheSessionLocal()
+    try:
+        load_cache_row_count(db)
+    finally:
+        db.close()
+    
     logger.info(f"Storage type: {get_storage_type()}")
     
+    app.state.render_pool = create_render_pool()
+    
     # Start background cache cleanup task
-    cleanup_task = asyncio.create_task(cache_cleanup_task())
+    shutdown_event = asyncio.Event()
+    cleanup_task = asyncio.create_task(cache_cleanup_task(shutdown_event))
     
     yield
     
-    # Shutdown - stop the cleanup task gracefully
-    _cleanup_task_running = False
-    cleanup_task.cancel()
-    try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+    # Shutdown - wake the cleanup task and let it exit on its own
+    shutdown_event.set()
+    await cleanup_task
     
-    logger.info("Cache cleanup task stopped")
+    # The pool may have been replaced since startup
+    app.state.render_pool.shutdown(wait=True, cancel_futures=True)
+    logger.info("Render pool stopped")
 
 
+# No default_response_class: since FastAPI 0.130 routes with a response_model
+# are serialized straight to JSON bytes by pydantic-core, which a custom
+# response class (ORJSONResponse included) would bypass.
 app = FastAPI(
     title="StarChart API",
     description="Generate beautiful star map images for any date and location",
@@ -107,8 +133,8 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
-    allow_headers=["X-API-Key", "Content-Type"],
-    expose_headers=["X-Cache-Id", "X-Cache-Hit"],  # Allow JS to read these response headers
+    allow_headers=["X-API-Key", "Content-Type", "If-None-Match"],
+    expose_headers=["X-Cache-Id", "X-Cache-Hit", "ETag"],  # Allow JS to read these response headers
 )
 
 # Include routers
@@ -116,12 +142,15 @@ app.include_router(starmaps.router, prefix="/api/v1/starmaps", tags=["starmaps"]
 
 
 @app.get("/health")
-async def health_check():
+async def health_check(settings: Settings = Depends(get_settings)):
     """Health check endpoint."""
     return {
         "status": "healthy",
         "storage_type": get_storage_type(),
         "cache_cleanup_interval_minutes": settings.cache_cleanup_interval_minutes,
-        "cache_max_age_hours": settings.cache_max_age_hours
+        "cache_max_age_hours": settings.cache_max_age_hours,
+        "db_pool_size": settings.db_pool_size,
+        "db_max_overflow": settings.db_max_overflow,
+        "sqlite_pool_size": settings.sqlite_pool_size
     }
 
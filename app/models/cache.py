@@ -1,8 +1,7 @@
 """SQLite cache model for temporary star map storage."""
-import uuid
 from datetime import datetime
 
-from sqlalchemy import Column, String, Float, Integer, LargeBinary, DateTime, Index
+from sqlalchemy import CHAR, Column, String, Float, Integer, DateTime, Index, text
 from sqlalchemy.orm import declarative_base
 
 CacheBase = declarative_base()
@@ -13,7 +12,9 @@ class CachedStarmap(CacheBase):
     
     __tablename__ = "cached_starmaps"
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    # Content-addressed key derived from the request parameters (see
+    # app.services.starmap._cache_key), so a lookup is a primary-key probe
+    id = Column(CHAR(32), primary_key=True)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     year = Column(Integer, nullable=False)
@@ -22,11 +23,17 @@ class CachedStarmap(CacheBase):
     hour = Column(Integer, nullable=False)
     minute = Column(Integer, nullable=False)
     timezone_offset = Column(Integer, nullable=False)
-    image_data = Column(LargeBinary, nullable=False)
+    image_path = Column(String(255), nullable=False)  # PNG under settings.cache_image_dir
+    image_sha1 = Column(String(40), nullable=False)  # Content hash, served as the ETag
     created_at = Column(DateTime, default=datetime.utcnow)
     
     __table_args__ = (
-        Index('idx_cache_lookup', 'latitude', 'longitude', 'year', 'month', 'day', 'hour'),
-        Index('idx_cache_created_at', 'created_at'),
+        # Serves cleanup's created_at range delete; rows without a timestamp
+        # are never expired, so they stay out of the index
+        Index('idx_cache_created_at', 'created_at', 'id',
+              sqlite_where=text('created_at IS NOT NULL')),
+        # Rows are clustered on the hash key itself, so there is no rowid
+        # B-tree plus a separate primary-key index to maintain
+        {'sqlite_with_rowid': False},
     )
 
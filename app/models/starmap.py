@@ -1,13 +1,53 @@
 """Model for permanent star map storage (PostgreSQL or SQLite compatible)."""
+import secrets
+import threading
+import time
 import uuid
 from datetime import datetime
-from typing import Any
 
-from sqlalchemy import Column, String, Float, Integer, LargeBinary, DateTime, Index, Text
+from sqlalchemy import Column, String, Float, Integer, DateTime, Index, Text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.types import TypeDecorator, CHAR
 
-from app.settings import settings
+__all__ = ["GUID", "JSONType", "StorageBase", "Starmap", "uuid7"]
+
+# Random bytes are drawn from os.urandom in 4 KB blocks rather than per id
+_RANDOM_POOL_SIZE = 4096
+_random_pool = b""
+_random_offset = 0
+_random_lock = threading.Lock()
+
+
+def _random_bytes(n: int) -> bytes:
+    """Take n bytes from the shared random pool, refilling it when exhausted."""
+    global _random_pool, _random_offset
+    with _random_lock:
+        if _random_offset + n > len(_random_pool):
+            _random_pool = secrets.token_bytes(_RANDOM_POOL_SIZE)
+            _random_offset = 0
+        chunk = _random_pool[_random_offset:_random_offset + n]
+        _random_offset += n
+    return chunk
+
+
+def uuid7() -> uuid.UUID:
+    """Time-ordered UUID (RFC 9562 version 7).
+    
+    The leading 48-bit millisecond timestamp keeps new primary keys close
+    together in the B-tree instead of scattering them like uuid4.
+    """
+    timestamp_ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(_random_bytes(10), "big")
+    rand_a = (rand >> 62) & 0xFFF
+    rand_b = rand & ((1 << 62) - 1)
+    value = (
+        (timestamp_ms & ((1 << 48) - 1)) << 80
+        | 0x7 << 76
+        | rand_a << 64
+        | 0b10 << 62
+        | rand_b
+    )
+    return uuid.UUID(int=value)
 
 
 class GUID(TypeDecorator):
@@ -88,19 +128,22 @@ class Starmap(StorageBase):
     
     __tablename__ = "starmaps"
     
-    id = Column(GUID(), primary_key=True, default=uuid.uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid7)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     observed_at = Column(DateTime(timezone=True), nullable=False)
     timezone_offset = Column(Integer, nullable=False)
     title = Column(String(255), nullable=True)
-    image_data = Column(LargeBinary, nullable=False)
+    image_path = Column(String(255), nullable=False)  # PNG under settings.storage_image_dir
+    image_sha1 = Column(String(40), nullable=False)  # Content hash, served as the ETag
     extra_data = Column(JSONType(), nullable=True)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
     updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
     
     __table_args__ = (
         Index('idx_starmaps_location', 'latitude', 'longitude'),
+        # Newest-first listing; (created_at, id) is the keyset cursor
+        Index('idx_starmaps_created', created_at.desc(), id.desc()),
         Index('idx_starmaps_observed', 'observed_at'),
     )
 
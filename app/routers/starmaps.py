@@ -1,45 +1,122 @@
 """Star map API endpoints."""
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from sqlalchemy.orm import Session
 
 from app.database.cache import get_cache_db
 from app.database.storage import get_storage_db
-from app.dependencies import verify_api_key
+from app.dependencies import get_render_pool, verify_api_key
+from app.models.starmap import Starmap
 from app.schemas.starmap import (
     GenerateRequest,
     SaveRequest,
     StarmapListResponse,
     StarmapResponse,
 )
+from app.services import image_store
 from app.services import starmap as starmap_service
+from app.services.render_pool import replace_broken_render_pool
 
 router = APIRouter(dependencies=[Depends(verify_api_key)])
 
+# Saved images never change under their id, so clients may keep them
+# indefinitely. Private because every request is authenticated.
+SAVED_IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def _to_response(starmap: Starmap) -> StarmapResponse:
+    """Build response metadata from a stored row without re-running validation."""
+    return StarmapResponse.model_construct(
+        id=starmap.id,
+        latitude=starmap.latitude,
+        longitude=starmap.longitude,
+        observed_at=starmap.observed_at,
+        title=starmap.title,
+        created_at=starmap.created_at
+    )
+
+
+def _etag(image_sha1: str) -> str:
+    return f'"{image_sha1}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Whether the client's If-None-Match already covers this ETag."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+def _png_response(
+    image_path: str,
+    image_sha1: str,
+    headers: Optional[dict] = None
+) -> Response:
+    """
+    Serve a PNG from disk, tagged with its content hash.
+    
+    The file is memory-mapped before the response is returned, so the body
+    is sent from the page cache without a copy and stays readable if cache
+    cleanup unlinks the file meanwhile.
+    
+    Raises:
+        FileNotFoundError: If the image file is missing
+    """
+    headers = dict(headers or {})
+    headers["ETag"] = _etag(image_sha1)
+    return Response(
+        content=image_store.read_image(image_path),
+        media_type="image/png",
+        headers=headers
+    )
+
 
 @router.post("/generate")
 async def generate_starmap(
     request: GenerateRequest,
-    db_cache: Session = Depends(get_cache_db)
+    http_request: Request,
+    db_cache: Session = Depends(get_cache_db),
+    render_pool: Optional[Executor] = Depends(get_render_pool)
 ) -> Response:
     """
     Generate a star map image for the given location and time.
     
     Returns PNG image with cache headers.
     """
-    image_data, cache_id, cache_hit = starmap_service.generate_or_get_cached(
-        db_cache=db_cache,
-        request=request
-    )
+    # One retry, for either of two transient failures:
+    # - a render process died and broke the pool, which is replaced first
+    # - cache cleanup removed the file between the lookup and opening it;
+    #   the second pass finds it missing, drops the stale entry and re-renders
+    for _ in range(2):
+        try:
+            image_path, image_sha1, cache_id, cache_hit = await starmap_service.generate_or_get_cached(
+                db_cache=db_cache,
+                request=request,
+                executor=render_pool
+            )
+            return _png_response(
+                image_path,
+                image_sha1,
+                headers={
+                    "X-Cache-Id": cache_id,
+                    "X-Cache-Hit": str(cache_hit).lower()
+                }
+            )
+        except BrokenProcessPool:
+            render_pool = replace_broken_render_pool(http_request.app.state, render_pool)
+        except FileNotFoundError:
+            pass
     
-    return Response(
-        content=image_data,
-        media_type="image/png",
-        headers={
-            "X-Cache-Id": cache_id,
-            "X-Cache-Hit": str(cache_hit).lower()
-        }
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Star map image is unavailable, try again",
+        headers={"Retry-After": "1"}
     )
 
 
@@ -71,18 +148,19 @@ async def save_starmap(
             detail=f"Cache entry {cache_id} not found"
         )
     
-    return StarmapResponse.model_validate(starmap)
+    return _to_response(starmap)
 
 
 @router.get("/{starmap_id}")
 async def get_starmap(
     starmap_id: UUID,
+    request: Request,
     db_storage: Session = Depends(get_storage_db)
 ) -> Response:
     """
     Get a saved star map image by ID.
     
-    Returns PNG image.
+    Returns PNG image, or 304 when If-None-Match carries its ETag.
     """
     starmap = starmap_service.get_by_id(db=db_storage, starmap_id=starmap_id)
     
@@ -92,32 +170,59 @@ async def get_starmap(
             detail="Star map not found"
         )
     
-    return Response(
-        content=starmap.image_data,
-        media_type="image/png"
-    )
+    cache_headers = {"Cache-Control": SAVED_IMAGE_CACHE_CONTROL}
+    etag = _etag(starmap.image_sha1)
+    if _etag_matches(request, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag, **cache_headers}
+        )
+    
+    try:
+        return _png_response(starmap.image_path, starmap.image_sha1, headers=cache_headers)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Star map image not found"
+        )
 
 
 @router.get("", response_model=StarmapListResponse)
 async def list_starmaps(
     skip: int = Query(0, ge=0),
     limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
     db_storage: Session = Depends(get_storage_db)
 ) -> StarmapListResponse:
     """
     List saved star maps with pagination.
+    
+    Either page with `skip`, or pass the previous page's `next_cursor` as
+    `cursor` (skip is then ignored), which stays fast however deep you go.
+    Cursor pages leave `total` null rather than counting every row.
     """
-    items, total = starmap_service.list_starmaps(
+    try:
+        after = starmap_service.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    
+    items, total, next_after = starmap_service.list_starmaps(
         db=db_storage,
         skip=skip,
-        limit=limit
+        limit=limit,
+        cursor=after
     )
     
-    return StarmapListResponse(
-        items=[StarmapResponse.model_validate(item) for item in items],
+    # Rows come from our own database, so skip per-item validation
+    return StarmapListResponse.model_construct(
+        items=[_to_response(item) for item in items],
         total=total,
         skip=skip,
-        limit=limit
+        limit=limit,
+        next_cursor=starmap_service.encode_cursor(*next_after) if next_after else None
     )
 
 
@@ -43,7 +43,8 @@ class StarmapListResponse(BaseModel):
     """Response schema for paginated star map list."""
     
     items: list[StarmapResponse]
-    total: int
+    total: Optional[int] = None  # Not counted when paging by cursor
     skip: int
     limit: int
+    next_cursor: Optional[str] = None  # Pass as `cursor` to fetch the following page
 
@@ -1,23 +1,34 @@
 """Star map image generation using Skyfield astronomy library."""
 import io
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Tuple
 
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')  # Non-interactive backend for server - MUST be before pyplot import
 import matplotlib.pyplot as plt
 from matplotlib.patches import Circle
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 from skyfield.api import Star, load, wgs84, Loader
 from skyfield.data import hipparcos
 from skyfield.errors import EphemerisRangeError
 
+from app.settings import get_settings
+
 logger = logging.getLogger(__name__)
 
 # Data directory for ephemeris files
 DATA_DIR = Path(__file__).parent.parent.parent / "data"
 
+# DejaVu fonts bundled with matplotlib, used by the Pillow renderer
+FONT_DIR = Path(matplotlib.get_data_path()) / "fonts" / "ttf"
+
+# Palette size for encoded PNGs
+PNG_PALETTE_COLORS = 64
+
 
 class StarMapGenerator:
     """Generates star map images using Skyfield astronomy library."""
@@ -32,27 +43,66 @@ class StarMapGenerator:
     CONSTELLATION_LINE_COLOR = "#4a5568"
     TEXT_COLOR = "#a5d6a7"
     
+    # Pillow renderer layout: output size, chart center and pixels per unit
+    # of the projected sky disc (radius 1.0 = horizon)
+    IMAGE_SIZE = (1500, 1700)
+    IMAGE_CENTER = (750, 850)
+    IMAGE_SCALE = 600
+    SUPERSAMPLE = 2
+    
     def __init__(self):
         self._stars = None
+        self._star_positions = None
+        self._magnitudes = None
         self._eph = None
+        self._font_cache = None
+        # Sync routes run in FastAPI's threadpool; without the lock two cold
+        # requests would both parse the catalog.
+        self._load_lock = threading.Lock()
     
     def _load_stars(self):
-        """Load Hipparcos star catalog (cached), dropping rows with NaN magnitude or position."""
+        """Load Hipparcos star catalog (cached), dropping rows with NaN magnitude or position.
+        
+        Only stars at or brighter than LIMITING_MAGNITUDE are kept: the cut is
+        time-invariant and removes most of the catalog before any astrometry.
+        """
         if self._stars is None:
-            with load.open(hipparcos.URL) as f:
-                df = hipparcos.load_dataframe(f)
-            self._stars = df[df['magnitude'].notna() & df['ra_degrees'].notna() & df['dec_degrees'].notna()]
-            logger.info("Loaded %d stars (dropped %d with NaN data)", len(self._stars), len(df) - len(self._stars))
+            with self._load_lock:
+                if self._stars is None:
+                    with load.open(hipparcos.URL) as f:
+                        df = hipparcos.load_dataframe(f)
+                    stars = df[df['magnitude'].notna() & df['ra_degrees'].notna() & df['dec_degrees'].notna()]
+                    logger.info("Loaded %d stars (dropped %d with NaN data)", len(stars), len(df) - len(stars))
+                    stars = stars[stars['magnitude'] <= self.LIMITING_MAGNITUDE]
+                    logger.info("Kept %d stars at magnitude <= %.1f", len(stars), self.LIMITING_MAGNITUDE)
+                    self._star_positions = Star.from_dataframe(stars)
+                    self._magnitudes = stars['magnitude'].to_numpy()
+                    self._stars = stars
         return self._stars
     
+    def _load_catalog(self) -> Tuple[Star, np.ndarray]:
+        """Skyfield Star and magnitude array for the bright-star catalog (cached).
+        
+        generate() works only on these, keeping pandas out of the per-request path.
+        """
+        self._load_stars()
+        return self._star_positions, self._magnitudes
+    
     def _load_ephemeris(self):
         """Load JPL ephemeris (cached)."""
         if self._eph is None:
-            DATA_DIR.mkdir(parents=True, exist_ok=True)
-            loader = Loader(str(DATA_DIR))
-            self._eph = loader('de421.bsp')
+            with self._load_lock:
+                if self._eph is None:
+                    DATA_DIR.mkdir(parents=True, exist_ok=True)
+                    loader = Loader(str(DATA_DIR))
+                    self._eph = loader('de421.bsp')
         return self._eph
     
+    def preload(self):
+        """Load the star catalog and ephemeris ahead of the first request."""
+        self._load_stars()
+        self._load_ephemeris()
+    
     def generate(
         self,
         latitude: float,
@@ -64,14 +114,14 @@ class StarMapGenerator:
         minute: int,
         timezone_offset: int,
         title: str = "THE NIGHT SKY"
-    ) -> bytes:
+    ) -> io.BytesIO:
         """
         Generate a star map PNG image.
         
         Returns:
-            PNG image as bytes
+            PNG image buffer, positioned at the start
         """
-        stars = self._load_stars()
+        star_positions, magnitudes = self._load_catalog()
         eph = self._load_ephemeris()
         
         # Create observation time
@@ -86,7 +136,6 @@ class StarMapGenerator:
         location = earth + observer
         
         # Compute star positions
-        star_positions = Star.from_dataframe(stars)
         astrometric = location.at(t).observe(star_positions)
 
         try:
@@ -100,23 +149,173 @@ class StarMapGenerator:
         alt_deg = alt.degrees
         az_deg = az.degrees
         
-        # Filter visible stars
-        visible = (alt_deg > 0) & (stars['magnitude'] <= self.LIMITING_MAGNITUDE)
-        visible_stars = stars[visible].copy()
-        visible_alt = alt_deg[visible]
-        visible_az = az_deg[visible]
+        # Filter visible stars (the catalog is already cut to LIMITING_MAGNITUDE)
+        visible = alt_deg > 0
+        
+        # Stereographic projection, r = cos(alt) / (1 + sin(alt)).
+        # Boolean indexing already returns fresh arrays, so every later step
+        # reuses them via out= instead of allocating a temporary per operation.
+        alt_rad = alt_deg[visible]
+        az_rad = az_deg[visible]
+        np.radians(alt_rad, out=alt_rad)
+        np.radians(az_rad, out=az_rad)
+        r = np.sin(alt_rad)
+        r += 1
+        np.divide(np.cos(alt_rad, out=alt_rad), r, out=r)
+        x = np.sin(az_rad)
+        x *= r
+        y = np.cos(az_rad, out=az_rad)
+        y *= r
+        np.negative(y, out=y)
+        
+        # Star sizes based on magnitude: (LIMITING_MAGNITUDE - m + 1) ** 2 * 2
+        sizes = np.subtract(self.LIMITING_MAGNITUDE + 1, magnitudes[visible])
+        np.square(sizes, out=sizes)
+        sizes *= 2
+        
+        date_str, coord_str = self._captions(latitude, longitude, year, month, day)
+        
+        if get_settings().renderer == "matplotlib":
+            return self._render_matplotlib(x, y, sizes, title, date_str, coord_str)
+        return self._render_pillow(x, y, sizes, title, date_str, coord_str)
+    
+    @staticmethod
+    def _captions(latitude: float, longitude: float, year: int, month: int, day: int) -> Tuple[str, str]:
+        """Date subtitle and coordinate line printed under the chart."""
+        month_names = ['', 'JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY', 'JUNE',
+                      'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER', 'NOVEMBER', 'DECEMBER']
+        day_suffix = 'th'
+        if day in [1, 21, 31]:
+            day_suffix = 'st'
+        elif day in [2, 22]:
+            day_suffix = 'nd'
+        elif day in [3, 23]:
+            day_suffix = 'rd'
+        
+        date_str = f"{day}{day_suffix} {month_names[month]} {year}"
+        
+        lat_dir = 'N' if latitude >= 0 else 'S'
+        lon_dir = 'W' if longitude < 0 else 'E'
+        coord_str = f"{abs(latitude):.4f}° {lat_dir} {abs(longitude):.4f}° {lon_dir}"
+        
+        return date_str, coord_str
+    
+    def _fonts(self) -> dict:
+        """TrueType fonts for the Pillow renderer, at SUPERSAMPLE scale (cached)."""
+        if self._font_cache is None:
+            def font(name: str, points: float) -> ImageFont.FreeTypeFont:
+                return ImageFont.truetype(str(FONT_DIR / name), round(points * self._px_per_point))
+            self._font_cache = {
+                "cardinal": font("DejaVuSans-Bold.ttf", 12),
+                "title": font("DejaVuSerif-Bold.ttf", 16),
+                "date": font("DejaVuSerif.ttf", 10),
+                "coords": font("DejaVuSerif.ttf", 9),
+            }
+        return self._font_cache
+    
+    @property
+    def _px_per_point(self) -> float:
+        """Pillow canvas pixels per typographic point, matching the matplotlib DPI."""
+        return self.DPI / 72 * self.SUPERSAMPLE
+    
+    def _render_pillow(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        sizes: np.ndarray,
+        title: str,
+        date_str: str,
+        coord_str: str
+    ) -> io.BytesIO:
+        """Draw the chart directly with Pillow (fixed layout, no figure machinery).
+        
+        Everything is drawn at SUPERSAMPLE times the output size and box-reduced
+        at the end, which antialiases the star discs and circles cheaply.
+        """
+        ss = self.SUPERSAMPLE
+        width, height = self.IMAGE_SIZE
+        cx, cy = self.IMAGE_CENTER
+        scale = self.IMAGE_SCALE * ss
+        cx, cy = cx * ss, cy * ss
+        px_per_point = self._px_per_point
+        fonts = self._fonts()
+        
+        background = ImageColor.getrgb(self.BACKGROUND_COLOR)
+        border = ImageColor.getrgb(self.BORDER_COLOR)
+        grid = _blend(self.CONSTELLATION_LINE_COLOR, background, 0.3)
+        star = _blend(self.STAR_COLOR, background, 0.9)
+        text = ImageColor.getrgb(self.TEXT_COLOR)
+        coord_text = _blend(self.TEXT_COLOR, background, 0.8)
         
-        # Stereographic projection
-        alt_rad = np.radians(visible_alt)
-        az_rad = np.radians(visible_az)
-        r = np.cos(alt_rad) / (1 + np.sin(alt_rad))
-        x = r * np.sin(az_rad)
-        y = -r * np.cos(az_rad)
+        img = Image.new("RGB", (width * ss, height * ss), background)
+        draw = ImageDraw.Draw(img)
         
-        # Star sizes based on magnitude
-        magnitudes = visible_stars['magnitude'].values
-        sizes = (self.LIMITING_MAGNITUDE - magnitudes + 1) ** 2 * 2
+        def circle_box(radius: float) -> Tuple[float, float, float, float]:
+            return (cx - radius, cy - radius, cx + radius, cy + radius)
         
+        # Border and horizon
+        draw.ellipse(circle_box(scale), outline=border, width=round(2 * px_per_point))
+        draw.ellipse(circle_box(0.98 * scale), fill=background, outline=border,
+                     width=round(1 * px_per_point))
+        
+        # Altitude reference circles (dashed)
+        dash = 3.7 * 0.5 * px_per_point
+        gap = 1.6 * 0.5 * px_per_point
+        line_width = max(1, round(0.5 * px_per_point))
+        for alt_line in [30, 60]:
+            r_line = np.cos(np.radians(alt_line)) / (1 + np.sin(np.radians(alt_line))) * scale
+            # Dashes are a few pixels long, so each is drawn as a straight
+            # chord (draw.arc rasterizes the whole ellipse on every call)
+            starts = np.arange(0, 2 * np.pi, (dash + gap) / r_line)
+            stops = starts + dash / r_line
+            x0, y0 = cx + r_line * np.cos(starts), cy + r_line * np.sin(starts)
+            x1, y1 = cx + r_line * np.cos(stops), cy + r_line * np.sin(stops)
+            for segment in zip(x0.tolist(), y0.tolist(), x1.tolist(), y1.tolist()):
+                draw.line(segment, fill=grid, width=line_width)
+        
+        # Cardinal direction lines (dashed)
+        for angle in [0, 90, 180, 270]:
+            rad = np.radians(angle)
+            dx, dy = np.sin(rad), np.cos(rad)  # data y = -cos, image y points down
+            for start in np.arange(0, scale, dash + gap):
+                stop = min(start + dash, scale)
+                draw.line((cx + dx * start, cy + dy * start, cx + dx * stop, cy + dy * stop),
+                          fill=grid, width=line_width)
+        
+        # Stars - scatter sizes are areas in points^2
+        star_x = cx + x * scale
+        star_y = cy - y * scale
+        star_r = np.sqrt(sizes) * (px_per_point / 2)
+        for sx, sy, sr in zip(star_x.tolist(), star_y.tolist(), star_r.tolist()):
+            draw.ellipse((sx - sr, sy - sr, sx + sr, sy + sr), fill=star)
+        
+        # Cardinal direction labels
+        for label, dx, dy in [('N', 0, -1.08), ('S', 0, 1.08), ('E', -1.08, 0), ('W', 1.08, 0)]:
+            draw.text((cx + dx * scale, cy - dy * scale), label, fill=text,
+                      font=fonts["cardinal"], anchor="mm")
+        
+        # Title, date subtitle and coordinates
+        draw.text((cx, cy - 1.18 * scale), title.upper(), fill=text, font=fonts["title"], anchor="md")
+        draw.text((cx, cy + 1.12 * scale), date_str, fill=text, font=fonts["date"], anchor="ma")
+        draw.text((cx, cy + 1.18 * scale), coord_str, fill=coord_text, font=fonts["coords"], anchor="ma")
+        
+        if ss > 1:
+            img = img.reduce(ss)
+        
+        return _encode_png(img)
+    
+    # Split long paths into chunks so Agg does not rasterise them in one pass
+    @plt.rc_context({'agg.path.chunksize': 10000})
+    def _render_matplotlib(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        sizes: np.ndarray,
+        title: str,
+        date_str: str,
+        coord_str: str
+    ) -> io.BytesIO:
+        """Draw the chart with matplotlib (reference renderer, RENDERER=matplotlib)."""
         # Create figure
         fig, ax = plt.subplots(figsize=self.FIGURE_SIZE, facecolor=self.BACKGROUND_COLOR)
         ax.set_facecolor(self.BACKGROUND_COLOR)
@@ -162,39 +361,59 @@ class StarMapGenerator:
                color=self.TEXT_COLOR, fontsize=16, fontweight='bold', fontfamily='serif')
         
         # Date subtitle
-        month_names = ['', 'JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY', 'JUNE',
-                      'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER', 'NOVEMBER', 'DECEMBER']
-        day_suffix = 'th'
-        if day in [1, 21, 31]:
-            day_suffix = 'st'
-        elif day in [2, 22]:
-            day_suffix = 'nd'
-        elif day in [3, 23]:
-            day_suffix = 'rd'
-        
-        date_str = f"{day}{day_suffix} {month_names[month]} {year}"
         ax.text(0, -1.12, date_str, ha='center', va='top',
                color=self.TEXT_COLOR, fontsize=10, fontfamily='serif')
         
         # Coordinates
-        lat_dir = 'N' if latitude >= 0 else 'S'
-        lon_dir = 'W' if longitude < 0 else 'E'
-        coord_str = f"{abs(latitude):.4f}° {lat_dir} {abs(longitude):.4f}° {lon_dir}"
         ax.text(0, -1.18, coord_str, ha='center', va='top',
                color=self.TEXT_COLOR, fontsize=9, fontfamily='serif', alpha=0.8)
         
         plt.tight_layout()
         
-        # Save to bytes
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=self.DPI, facecolor=self.BACKGROUND_COLOR,
-                   bbox_inches='tight', pad_inches=0.5)
+        # Save uncompressed, then re-encode as a palette PNG
+        raw = io.BytesIO()
+        fig.savefig(raw, format='png', dpi=self.DPI, facecolor=self.BACKGROUND_COLOR,
+                   bbox_inches='tight', pad_inches=0.5, pil_kwargs={"compress_level": 0})
         plt.close(fig)
-        buf.seek(0)
+        raw.seek(0)
         
-        return buf.read()
+        with Image.open(raw) as img:
+            return _encode_png(img.convert("RGB"))
 
 
-# Singleton instance
+def _encode_png(img: Image.Image) -> io.BytesIO:
+    """Encode a rendered map as a fast, low-compression palette PNG.
+
+    The maps are mostly flat background with a handful of star and text
+    colors, so 64 palette entries hold them without visible banding, and
+    zlib level 1 on 8-bit indices is far cheaper than level 6 on RGB.
+    """
+    img = img.quantize(colors=PNG_PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=1, optimize=False)
+    buf.seek(0)
+    return buf
+
+
+def _blend(color: str, background: Tuple[int, int, int], alpha: float) -> Tuple[int, int, int]:
+    """Pre-composite a hex color over an RGB background at the given opacity."""
+    fg = ImageColor.getrgb(color)
+    return tuple(round(f * alpha + b * (1 - alpha)) for f, b in zip(fg, background))
+
+
+# Singleton instance (one per process, including each render worker)
 generator = StarMapGenerator()
 
+
+def render_starmap(params: dict) -> bytes:
+    """Render with this process's generator; picklable entry point for process pools."""
+    return generator.generate(**params).getvalue()
+
+
+def preload_render_worker() -> None:
+    """Load astronomy data in a render worker ahead of its first job."""
+    try:
+        generator.preload()
+    except Exception as e:
+        logger.error(f"Astronomy data preload failed, will retry on first render: {e}")
+
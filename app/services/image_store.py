@@ -0,0 +1,96 @@
+"""Filesystem storage for star map PNGs referenced by database rows.
+
+Each file belongs to exactly one row and is named after it, so removing a
+row's file never needs to check whether another row still uses it. Files
+are sharded into directories by their content hash, which spreads them
+evenly however the row names are ordered (UUIDv7 names share a time prefix).
+"""
+import hashlib
+import mmap
+import os
+import uuid
+from pathlib import Path
+from typing import Tuple
+
+
+def image_path_for(root: str, name: str, image_sha1: str) -> Path:
+    """Path for an image, sharded by the first two character pairs of its SHA-1."""
+    return Path(root) / image_sha1[:2] / image_sha1[2:4] / f"{name}.png"
+
+
+def _write_atomic(path: Path, data) -> None:
+    """Write data to a temporary file and rename it into place, so readers
+    never see a partially written image."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+
+    view = memoryview(data)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = 0
+        while written < view.nbytes:
+            written += os.write(fd, view[written:])
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+
+def write_image(root: str, name: str, data) -> Tuple[str, str]:
+    """Write PNG bytes under root and return (path, sha1 of the content)."""
+    image_sha1 = hashlib.sha1(data).hexdigest()
+    path = image_path_for(root, name, image_sha1)
+    _write_atomic(path, data)
+    return str(path), image_sha1
+
+
+def link_image(source_path: str, image_sha1: str, root: str, name: str) -> str:
+    """Give an existing image a second name under root and return its path.
+
+    The file is hard-linked rather than copied, so either name can be
+    removed without affecting the other. Falls back to a copy where links
+    are not possible (e.g. the roots are on different filesystems).
+
+    Raises:
+        FileNotFoundError: If the source image is missing
+    """
+    path = image_path_for(root, name, image_sha1)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source_path, path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        _write_atomic(path, read_image(source_path))
+
+    return str(path)
+
+
+def stat_image(path: str) -> os.stat_result:
+    """Stat an image file, e.g. to check that it still exists.
+
+    Raises:
+        FileNotFoundError: If the image file is missing
+    """
+    return os.stat(path)
+
+
+def read_image(path: str) -> memoryview:
+    """Memory-map an image read-only.
+
+    Raises:
+        FileNotFoundError: If the image file is missing
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    return memoryview(mapped)
+
+
+def delete_image(path: str) -> None:
+    """Remove an image file if it exists."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
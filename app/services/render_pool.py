@@ -0,0 +1,52 @@
+"""Process pool that runs star map renders."""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.datastructures import State
+
+from app.services.generator import preload_render_worker
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+def create_render_pool() -> ProcessPoolExecutor:
+    """
+    Start the render pool with every worker preloaded.
+    
+    matplotlib holds the GIL while rasterizing, so renders only run in
+    parallel across processes. Spawned (not forked) workers don't inherit
+    the event loop or open database connections.
+    """
+    render_workers = get_settings().render_workers or os.cpu_count() or 1
+    # Every worker loads the star catalog and ephemeris in its initializer,
+    # before it takes any job, so no request pays for the load
+    render_pool = ProcessPoolExecutor(
+        max_workers=render_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=preload_render_worker
+    )
+    
+    # Spawned workers start on demand; queue one trivial job per worker so
+    # they all start (and preload) now rather than on the first requests
+    for _ in range(render_workers):
+        render_pool.submit(os.getpid)
+    logger.info(f"Render pool started with {render_workers} workers")
+    return render_pool
+
+
+def replace_broken_render_pool(state: State, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    """
+    Replace state.render_pool after a worker died and return the current pool.
+    
+    A dead worker (OOM kill, native crash) breaks the whole pool, so every
+    request that was using it fails; only the first to get here starts a
+    new one, the rest receive it.
+    """
+    if state.render_pool is broken:
+        logger.warning("Render pool broken by a dead worker, starting a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+        state.render_pool = create_render_pool()
+    return state.render_pool
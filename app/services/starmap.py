@@ -1,14 +1,96 @@
 """Business logic layer for star map operations."""
+import asyncio
+import base64
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Tuple
-from uuid import UUID
+from uuid import UUID, uuid4
 
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, delete, func, insert, select, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, load_only
 
 from app.models.cache import CachedStarmap
-from app.models.starmap import Starmap
+from app.models.starmap import Starmap, uuid7
 from app.schemas.starmap import GenerateRequest
-from app.services.generator import generator
+from app.services import image_store
+from app.services.generator import render_starmap
+from app.settings import get_settings
+
+
+# Rows currently in the cache table, kept in step with inserts and deletes
+# so the cleanup task can skip its DELETE while nothing could expire
+_cache_row_count = 0
+_cache_row_lock = threading.Lock()
+
+
+def _adjust_cache_row_count(delta: int) -> None:
+    global _cache_row_count
+    with _cache_row_lock:
+        _cache_row_count = max(0, _cache_row_count + delta)
+
+
+def load_cache_row_count(db_cache: Session) -> int:
+    """Initialize the cache row counter from the table (called at startup)."""
+    global _cache_row_count
+    count = db_cache.execute(select(func.count()).select_from(CachedStarmap)).scalar_one()
+    with _cache_row_lock:
+        _cache_row_count = count
+    return count
+
+
+def cache_has_entries() -> bool:
+    """Whether any cache rows exist that cleanup might need to expire."""
+    return _cache_row_count > 0
+
+
+# (image_path, image_sha1) of recently served cache entries, checked before
+# SQLite so repeated requests for the same sky (e.g. dragging a date slider)
+# skip the database. Only paths are kept; the OS page cache holds the PNG pages.
+_mem_cache: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+_mem_cache_lock = threading.Lock()
+
+
+def _mem_cache_get(cache_id: str) -> Optional[Tuple[str, str]]:
+    with _mem_cache_lock:
+        entry = _mem_cache.get(cache_id)
+        if entry is not None:
+            _mem_cache.move_to_end(cache_id)
+        return entry
+
+
+def _mem_cache_put(cache_id: str, entry: Tuple[str, str]) -> None:
+    max_entries = get_settings().memory_cache_size
+    if max_entries <= 0:
+        return
+    with _mem_cache_lock:
+        _mem_cache[cache_id] = entry
+        _mem_cache.move_to_end(cache_id)
+        while len(_mem_cache) > max_entries:
+            _mem_cache.popitem(last=False)
+
+
+def _mem_cache_discard(cache_id: Optional[str] = None) -> None:
+    """Drop one memoized entry, or all of them when cache_id is None."""
+    with _mem_cache_lock:
+        if cache_id is None:
+            _mem_cache.clear()
+        else:
+            _mem_cache.pop(cache_id, None)
+
+
+# Cache rows removed per DELETE statement during cleanup
+CLEANUP_BATCH_SIZE = 1000
+
+# Hot-path lookup built once at import; per call only the key is bound, and
+# selecting bare columns skips ORM instance loading
+_CACHE_IMAGE_QUERY = select(CachedStarmap.image_path, CachedStarmap.image_sha1).where(
+    CachedStarmap.id == bindparam("k")
+)
 
 
 def _round_coords(lat: float, lon: float) -> Tuple[float, float]:
@@ -16,63 +98,153 @@ def _round_coords(lat: float, lon: float) -> Tuple[float, float]:
     return round(lat, 4), round(lon, 4)
 
 
-def generate_or_get_cached(
+# Binary layout hashed into the cache key, compiled once:
+# lat, lon, year, month, day, hour, minute, timezone_offset
+_pack_cache_key = struct.Struct("<ddhBBBBb").pack
+
+
+def _cache_key(lat: float, lon: float, request: GenerateRequest) -> str:
+    """Deterministic cache id for rounded coordinates and observation time."""
+    packed = _pack_cache_key(
+        lat, lon, request.year, request.month, request.day,
+        request.hour, request.minute, request.timezone_offset
+    )
+    return hashlib.blake2b(packed, digest_size=16).hexdigest()
+
+
+async def generate_or_get_cached(
     db_cache: Session,
-    request: GenerateRequest
-) -> Tuple[bytes, str, bool]:
+    request: GenerateRequest,
+    executor: Optional[Executor] = None
+) -> Tuple[str, str, str, bool]:
     """
     Generate star map or return from cache.
     
+    On a miss the image is rendered in `executor` (the default executor
+    when None). The cache lookup and the store, with their SQLite
+    transactions and file writes, run on the default executor, so the event
+    loop never waits on a database lock held by cleanup. They are separate
+    short transactions, so no SQLite connection or read snapshot is held
+    while rendering.
+    
+    The image is returned as a file path so it can be served straight from
+    disk; its SHA-1 doubles as an ETag.
+    
     Returns:
-        Tuple of (image_bytes, cache_id, cache_hit)
+        Tuple of (image_path, image_sha1, cache_id, cache_hit)
+    
+    Raises:
+        BrokenProcessPool: If a render process died (from a process executor)
     """
     lat, lon = _round_coords(request.latitude, request.longitude)
+    cache_id = _cache_key(lat, lon, request)
+    loop = asyncio.get_running_loop()
     
-    # Check cache
-    cached = db_cache.query(CachedStarmap).filter(
-        CachedStarmap.latitude == lat,
-        CachedStarmap.longitude == lon,
-        CachedStarmap.year == request.year,
-        CachedStarmap.month == request.month,
-        CachedStarmap.day == request.day,
-        CachedStarmap.hour == request.hour,
-        CachedStarmap.minute == request.minute,
-        CachedStarmap.timezone_offset == request.timezone_offset
-    ).first()
-    
-    if cached:
-        return cached.image_data, cached.id, True
+    cached = await loop.run_in_executor(None, _get_cached, db_cache, cache_id)
+    if cached is not None:
+        return cached[0], cached[1], cache_id, True
     
     # Generate new image
-    image_data = generator.generate(
-        latitude=lat,
-        longitude=lon,
-        year=request.year,
-        month=request.month,
-        day=request.day,
-        hour=request.hour,
-        minute=request.minute,
-        timezone_offset=request.timezone_offset,
-        title=request.title or "THE NIGHT SKY"
-    )
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "year": request.year,
+        "month": request.month,
+        "day": request.day,
+        "hour": request.hour,
+        "minute": request.minute,
+        "timezone_offset": request.timezone_offset,
+        "title": request.title or "THE NIGHT SKY"
+    }
+    image_data = await loop.run_in_executor(executor, render_starmap, params)
     
-    # Store in cache
-    new_cached = CachedStarmap(
-        latitude=lat,
-        longitude=lon,
-        year=request.year,
-        month=request.month,
-        day=request.day,
-        hour=request.hour,
-        minute=request.minute,
-        timezone_offset=request.timezone_offset,
-        image_data=image_data
+    image_path, image_sha1 = await loop.run_in_executor(
+        None, _store_cached, db_cache, cache_id, lat, lon, request, image_data
     )
-    db_cache.add(new_cached)
-    db_cache.commit()
-    db_cache.refresh(new_cached)
+    return image_path, image_sha1, cache_id, False
+
+
+def _get_cached(db_cache: Session, cache_id: str) -> Optional[Tuple[str, str]]:
+    """(image_path, image_sha1) of a cached image whose file still exists, or None."""
+    # Check memory, then the SQLite cache
+    memoized = _mem_cache_get(cache_id)
+    if memoized is not None:
+        try:
+            image_store.stat_image(memoized[0])
+        except FileNotFoundError:
+            _mem_cache_discard(cache_id)
+        else:
+            return memoized
     
-    return image_data, new_cached.id, False
+    with db_cache.begin():
+        cached = db_cache.execute(_CACHE_IMAGE_QUERY, {"k": cache_id}).first()
+    
+    if not cached:
+        return None
+    try:
+        image_store.stat_image(cached.image_path)
+    except FileNotFoundError:
+        # Image file was removed behind our back; drop the row (unless a
+        # concurrent request already replaced it) and regenerate
+        with db_cache.begin():
+            removed = db_cache.execute(
+                delete(CachedStarmap)
+                .where(CachedStarmap.id == cache_id)
+                .where(CachedStarmap.image_path == cached.image_path)
+            ).rowcount
+        _adjust_cache_row_count(-removed)
+        return None
+    
+    _mem_cache_put(cache_id, (cached.image_path, cached.image_sha1))
+    return cached.image_path, cached.image_sha1
+
+
+def _store_cached(
+    db_cache: Session,
+    cache_id: str,
+    lat: float,
+    lon: float,
+    request: GenerateRequest,
+    image_data: bytes
+) -> Tuple[str, str]:
+    """Cache a rendered image and return the (image_path, image_sha1) to serve."""
+    # The PNG goes to disk, the row only keeps its path. The file name is
+    # unique to this insert, so cleanup can unlink an expired row's file
+    # without racing a request that re-caches the same key.
+    image_path, image_sha1 = image_store.write_image(
+        get_settings().cache_image_dir, f"{cache_id}-{uuid4().hex[:8]}", image_data
+    )
+    # ON CONFLICT DO NOTHING makes a concurrent request caching the same key
+    # harmless; RETURNING only yields a row when this statement inserted it
+    with db_cache.begin():
+        inserted = db_cache.execute(
+            sqlite_insert(CachedStarmap).values(
+                id=cache_id,
+                latitude=lat,
+                longitude=lon,
+                year=request.year,
+                month=request.month,
+                day=request.day,
+                hour=request.hour,
+                minute=request.minute,
+                timezone_offset=request.timezone_offset,
+                image_path=image_path,
+                image_sha1=image_sha1
+            )
+            .on_conflict_do_nothing(index_elements=[CachedStarmap.id])
+            .returning(CachedStarmap.id)
+        ).scalar_one_or_none()
+        existing = None
+        if inserted is None:
+            existing = db_cache.execute(_CACHE_IMAGE_QUERY, {"k": cache_id}).first()
+    if inserted is not None:
+        _adjust_cache_row_count(1)
+    elif existing is not None:
+        # The other request's row won; serve its file and drop ours
+        image_store.delete_image(image_path)
+        image_path, image_sha1 = existing.image_path, existing.image_sha1
+    _mem_cache_put(cache_id, (image_path, image_sha1))
+    return image_path, image_sha1
 
 
 def save_to_storage(
@@ -87,13 +259,16 @@ def save_to_storage(
     Raises:
         ValueError: If cache_id not found
     """
-    cached = db_cache.query(CachedStarmap).filter(
-        CachedStarmap.id == cache_id
-    ).first()
+    # Read in its own short transaction; the row stays usable afterwards
+    with db_cache.begin():
+        cached = db_cache.get(CachedStarmap, cache_id)
     
     if not cached:
         raise ValueError(f"Cache entry {cache_id} not found")
     
+    # The saved copy is served from storage from now on
+    _mem_cache_discard(cache_id)
+    
     # Create observed_at datetime
     tz = timezone(timedelta(hours=cached.timezone_offset))
     observed_at = datetime(
@@ -101,49 +276,185 @@ def save_to_storage(
         cached.hour, cached.minute, tzinfo=tz
     )
     
-    # Insert to PostgreSQL
-    starmap = Starmap(
-        latitude=cached.latitude,
-        longitude=cached.longitude,
-        observed_at=observed_at,
-        timezone_offset=cached.timezone_offset,
-        title=title,
-        image_data=cached.image_data
-    )
-    db_storage.add(starmap)
-    db_storage.commit()
-    db_storage.refresh(starmap)
+    # Link the cached file into storage under the new row's own name, so it
+    # outlives cache cleanup without copying the bytes and deleting this
+    # map can never take another saved map's image with it
+    starmap_id = uuid7()
+    try:
+        image_path = image_store.link_image(
+            cached.image_path, cached.image_sha1, get_settings().storage_image_dir, starmap_id.hex
+        )
+    except FileNotFoundError:
+        raise ValueError(f"Cache entry {cache_id} not found")
+    
+    # Insert to permanent storage; RETURNING loads the row (including
+    # created_at) in the same statement instead of a refresh SELECT
+    with db_storage.begin():
+        starmap = db_storage.execute(
+            insert(Starmap).values(
+                id=starmap_id,
+                latitude=cached.latitude,
+                longitude=cached.longitude,
+                observed_at=observed_at,
+                timezone_offset=cached.timezone_offset,
+                title=title,
+                image_path=image_path,
+                image_sha1=cached.image_sha1
+            ).returning(Starmap)
+        ).scalar_one()
     
     return starmap
 
 
 def get_by_id(db: Session, starmap_id: UUID) -> Optional[Starmap]:
     """Get starmap from permanent storage by ID."""
-    return db.query(Starmap).filter(Starmap.id == starmap_id).first()
+    return db.get(Starmap, starmap_id)
+
+
+def encode_cursor(created_at: datetime, starmap_id: UUID) -> str:
+    """Opaque list cursor for the row a page ended on."""
+    raw = f"{created_at.isoformat()}|{starmap_id.hex}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """
+    Parse a cursor produced by encode_cursor.
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, starmap_id = raw.split("|")
+        return datetime.fromisoformat(created_at), UUID(hex=starmap_id)
+    except (UnicodeDecodeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+
+
+def list_starmaps(
+    db: Session,
+    skip: int = 0,
+    limit: int = 20,
+    cursor: Optional[Tuple[datetime, UUID]] = None
+) -> Tuple[list[Starmap], Optional[int], Optional[Tuple[datetime, UUID]]]:
+    """
+    List starmaps newest first.
+    
+    With a cursor (the (created_at, id) a previous page ended on) the page
+    starts right after it via the created_at/id index, so deep pages cost
+    the same as the first; skip is ignored and no total is counted. Without
+    one, skip is an offset.
+    
+    next_cursor is set whenever the page is full, so when exactly limit rows
+    remain the following page comes back empty.
+    
+    Returns:
+        Tuple of (items, total, next_cursor); total is None in cursor mode,
+        next_cursor is None on the last page
+    """
+    # Only the columns a list item shows are loaded; image and bookkeeping
+    # columns stay unloaded
+    stmt = (
+        select(Starmap)
+        .options(load_only(
+            Starmap.id, Starmap.latitude, Starmap.longitude,
+            Starmap.observed_at, Starmap.title, Starmap.created_at
+        ))
+        .order_by(Starmap.created_at.desc(), Starmap.id.desc())
+        .limit(limit)
+    )
+    if cursor is not None:
+        items = list(db.execute(
+            stmt.where(tuple_(Starmap.created_at, Starmap.id) < tuple(cursor))
+        ).scalars())
+        return items, None, _next_cursor(items, limit)
+    
+    # COUNT(*) OVER () is computed before LIMIT/OFFSET, so every row carries
+    # the full total in the same round trip
+    stmt = stmt.add_columns(func.count().over().label("total")).offset(skip)
+    rows = db.execute(stmt).all()
+    
+    if rows:
+        items = [row.Starmap for row in rows]
+        return items, rows[0].total, _next_cursor(items, limit)
+    
+    # An empty page has no row to carry the total; only past the end does
+    # that need a separate count
+    if skip == 0:
+        return [], 0, None
+    total = db.execute(select(func.count()).select_from(Starmap)).scalar_one()
+    return [], total, None
 
 
-def list_starmaps(db: Session, skip: int = 0, limit: int = 20) -> Tuple[list[Starmap], int]:
-    """List starmaps with pagination."""
-    total = db.query(Starmap).count()
-    items = db.query(Starmap).order_by(Starmap.created_at.desc()).offset(skip).limit(limit).all()
-    return items, total
+def _next_cursor(items: list[Starmap], limit: int) -> Optional[Tuple[datetime, UUID]]:
+    """Cursor after the last item of a full page, or None after a short one."""
+    if len(items) < limit:
+        return None
+    return items[-1].created_at, items[-1].id
 
 
 def delete_starmap(db: Session, starmap_id: UUID) -> bool:
     """Delete starmap from permanent storage."""
-    starmap = db.query(Starmap).filter(Starmap.id == starmap_id).first()
-    if starmap:
-        db.delete(starmap)
-        db.commit()
-        return True
-    return False
+    # Delete without loading the row; RETURNING hands back what's needed to
+    # clean up the file
+    image_path = db.execute(
+        delete(Starmap)
+        .where(Starmap.id == starmap_id)
+        .returning(Starmap.image_path)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    db.commit()
+    if image_path is None:
+        return False
+    image_store.delete_image(image_path)
+    return True
 
 
-def cleanup_old_cache(db_cache: Session, max_age_hours: int = 24):
-    """Remove cache entries older than max_age_hours."""
+def cleanup_old_cache(db_cache: Session, max_age_hours: int = 24) -> int:
+    """
+    Remove cache entries older than max_age_hours, along with their image files.
+    
+    Returns:
+        Number of cache entries removed
+    """
     cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
-    db_cache.query(CachedStarmap).filter(
-        CachedStarmap.created_at < cutoff
-    ).delete()
-    db_cache.commit()
-
+    expired = CachedStarmap.created_at < cutoff
+    
+    # Delete in bounded batches over the created_at index, committing each,
+    # so a large backlog never holds the write lock for long. RETURNING hands
+    # back the file paths without a separate SELECT.
+    batch_delete = (
+        delete(CachedStarmap)
+        .where(expired)
+        .where(CachedStarmap.id.in_(
+            select(CachedStarmap.id).where(expired).limit(CLEANUP_BATCH_SIZE)
+        ))
+        .returning(CachedStarmap.image_path)
+        .execution_options(synchronize_session=False)
+    )
+    
+    total_removed = 0
+    while True:
+        removed = db_cache.execute(batch_delete).scalars().all()
+        db_cache.commit()
+        if not removed:
+            break
+        total_removed += len(removed)
+        _adjust_cache_row_count(-len(removed))
+        _mem_cache_discard()
+        
+        # Each file belongs to the row that was just deleted
+        for path in removed:
+            image_store.delete_image(path)
+        
+        if len(removed) < CLEANUP_BATCH_SIZE:
+            break
+    
+    if total_removed:
+        # Reclaim the WAL pages the delete produced and refresh planner stats
+        db_cache.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        db_cache.execute(text("PRAGMA optimize"))
+        db_cache.commit()
+    
+    return total_removed
@@ -2,9 +2,10 @@
 """Development server runner."""
 import uvicorn
 
-from app.settings import settings
+from app.settings import get_settings
 
 if __name__ == "__main__":
+    settings = get_settings()
     uvicorn.run(
         "app.main:app",
         host=settings.host,
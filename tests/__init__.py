@@ -0,0 +1,6 @@
+import os
+
+# Settings needed to import the database modules; nothing connects to them
+os.environ.setdefault("API_KEY", "test")
+os.environ.setdefault("STORAGE_TYPE", "sqlite")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
@@ -0,0 +1,69 @@
+"""Keyset pagination of saved star maps."""
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.starmap import StorageBase, Starmap, uuid7
+from app.services import starmap as starmap_service
+
+
+class CursorTests(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://", poolclass=StaticPool)
+        StorageBase.metadata.create_all(bind=engine)
+        self.addCleanup(engine.dispose)
+        self.db = sessionmaker(bind=engine)()
+        self.addCleanup(self.db.close)
+
+    def _add_starmaps(self, count: int) -> None:
+        start = datetime(2024, 1, 1)
+        for i in range(count):
+            self.db.add(Starmap(
+                id=uuid7(), latitude=0.0, longitude=0.0, observed_at=start,
+                timezone_offset=0, image_path=f"{i}.png", image_sha1="0" * 40,
+                created_at=start + timedelta(minutes=i)
+            ))
+        self.db.commit()
+
+    def test_cursor_round_trip(self):
+        created_at, starmap_id = datetime(2024, 5, 6, 7, 8, 9, 123456), uuid7()
+        cursor = starmap_service.encode_cursor(created_at, starmap_id)
+        self.assertEqual(starmap_service.decode_cursor(cursor), (created_at, starmap_id))
+
+    def test_invalid_cursor(self):
+        for cursor in ("", "not-a-cursor", "bm9waXBl"):
+            with self.assertRaises(ValueError):
+                starmap_service.decode_cursor(cursor)
+
+    def test_pages_follow_on_without_total(self):
+        self._add_starmaps(5)
+        first, total, after = starmap_service.list_starmaps(self.db, limit=3)
+        self.assertEqual(total, 5)
+
+        second, total, after = starmap_service.list_starmaps(self.db, limit=3, cursor=after)
+        self.assertIsNone(total)
+        self.assertIsNone(after)
+        created = [item.created_at for item in first + second]
+        self.assertEqual(created, sorted(created, reverse=True))
+        self.assertEqual(len({item.id for item in first + second}), 5)
+
+    def test_exactly_limit_rows_left(self):
+        self._add_starmaps(4)
+        first, _, after = starmap_service.list_starmaps(self.db, limit=2)
+        second, _, after = starmap_service.list_starmaps(
+            self.db, limit=2, cursor=starmap_service.decode_cursor(starmap_service.encode_cursor(*after))
+        )
+        self.assertEqual(len(second), 2)
+        self.assertIsNotNone(after)
+
+        last, total, after = starmap_service.list_starmaps(self.db, limit=2, cursor=after)
+        self.assertEqual(last, [])
+        self.assertIsNone(total)
+        self.assertIsNone(after)
+
+
+if __name__ == "__main__":
+    unittest.main()
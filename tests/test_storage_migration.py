@@ -0,0 +1,111 @@
+"""Upgrading storage databases created before images moved to disk."""
+import hashlib
+import tempfile
+import threading
+import unittest
+import uuid
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+from sqlalchemy import (
+    CHAR, Column, DateTime, Float, Index, Integer, LargeBinary, MetaData, String, Table, Text,
+    create_engine, inspect, select,
+)
+
+from app.database.storage import upgrade_storage_schema
+from app.models.starmap import Starmap
+from app.settings import get_settings
+
+# starmaps as created by the releases that kept PNGs in image_data
+baseline_metadata = MetaData()
+baseline_starmaps = Table(
+    "starmaps", baseline_metadata,
+    Column("id", CHAR(36), primary_key=True),
+    Column("latitude", Float, nullable=False),
+    Column("longitude", Float, nullable=False),
+    Column("observed_at", DateTime(timezone=True), nullable=False),
+    Column("timezone_offset", Integer, nullable=False),
+    Column("title", String(255), nullable=True),
+    Column("image_data", LargeBinary, nullable=False),
+    Column("extra_data", Text, nullable=True),
+    Column("created_at", DateTime(timezone=True)),
+    Column("updated_at", DateTime(timezone=True)),
+    Index("idx_starmaps_location", "latitude", "longitude"),
+    Index("idx_starmaps_observed", "observed_at"),
+)
+
+
+class ImageDataMigrationTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.image_dir = Path(tmp.name) / "images"
+        patcher = mock.patch.object(get_settings(), "storage_image_dir", str(self.image_dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+        self.engine = create_engine(f"sqlite:///{tmp.name}/storage.db")
+        self.addCleanup(self.engine.dispose)
+        baseline_metadata.create_all(bind=self.engine)
+        
+        # More rows than one SELECT batch
+        self.images = {uuid.uuid4(): f"png {i}".encode() for i in range(250)}
+        with self.engine.begin() as conn:
+            conn.execute(baseline_starmaps.insert(), [
+                {
+                    "id": str(starmap_id), "latitude": 1.0, "longitude": 2.0,
+                    "observed_at": datetime(2024, 1, 1), "timezone_offset": 0,
+                    "image_data": data, "created_at": datetime(2024, 1, 2),
+                }
+                for starmap_id, data in self.images.items()
+            ])
+
+    def assert_migrated(self):
+        columns = {column["name"] for column in inspect(self.engine).get_columns("starmaps")}
+        self.assertNotIn("image_data", columns)
+        self.assertLessEqual({"image_path", "image_sha1"}, columns)
+        indexes = {index["name"] for index in inspect(self.engine).get_indexes("starmaps")}
+        self.assertIn("idx_starmaps_created", indexes)
+        
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(Starmap.id, Starmap.image_path, Starmap.image_sha1)).all()
+        self.assertEqual({row.id for row in rows}, set(self.images))
+        for row in rows:
+            path = Path(row.image_path)
+            self.assertTrue(path.is_relative_to(self.image_dir))
+            self.assertTrue(path.name.startswith(row.id.hex))
+            data = path.read_bytes()
+            self.assertEqual(data, self.images[row.id])
+            self.assertEqual(row.image_sha1, hashlib.sha1(data).hexdigest())
+        self.assertEqual(len(list(self.image_dir.rglob("*.png"))), len(self.images))
+
+    def test_moves_images_to_files_and_drops_column(self):
+        upgrade_storage_schema(self.engine)
+        self.assert_migrated()
+        
+        # Already upgraded: a second start changes nothing
+        upgrade_storage_schema(self.engine)
+        self.assert_migrated()
+
+    def test_workers_starting_together(self):
+        errors = []
+        
+        def start_worker():
+            try:
+                upgrade_storage_schema(self.engine)
+            except Exception as exc:
+                errors.append(exc)
+        
+        workers = [threading.Thread(target=start_worker) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        self.assertEqual(errors, [])
+        self.assert_migrated()
+
+
+if __name__ == "__main__":
+    unittest.main()